@@ -4,9 +4,11 @@
 # Nota: le notifiche locali richiedono 'plyer' (opzionale).
 
 import os
+import sys
 import sqlite3
 import json
 import traceback
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from kivy.app import App
@@ -29,6 +31,8 @@ DB_PATH = os.path.join(os.path.expanduser("~"), DB_FILENAME)
 EXT_BACKUP_PATH = "/sdcard/CarPlus_backup.json"
 FALLBACK_BACKUP_PATH = os.path.join(os.path.expanduser("~"), "CarPlus_backup.json")
 
+QUERY_CACHE_MAX_BYTES = 512 * 1024  # limite cache risultati query
+
 # Theme colors (RGBA)
 COLOR_VIOLET = (0.35, 0.15, 0.45, 1)   # viola
 COLOR_GOLD = (0.96, 0.76, 0.12, 1)     # oro
@@ -132,6 +136,74 @@ try:
 except Exception as e:
     print("DB init error:", e)
 
+# ---------------- Query result cache ----------------
+def _rows_size(rows):
+    """Approximate memory footprint (bytes) of a list of result rows."""
+    size = sys.getsizeof(rows)
+    for r in rows:
+        size += sys.getsizeof(r)
+        for v in r:
+            size += sys.getsizeof(v)
+    return size
+
+class QueryCache:
+    """LRU cache of SELECT results keyed by (sql, params), bounded in bytes.
+    Each entry is tagged with the tables it reads; writes call invalidate(table)."""
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()   # key -> (rows, tables, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, rows, tables):
+        size = _rows_size(rows)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[2]
+        self.entries[key] = (rows, frozenset(tables), size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, _, old_size) = self.entries.popitem(last=False)
+            self.size -= old_size
+
+    def invalidate(self, *tables):
+        """Drop every entry depending on any of the given tables."""
+        for key in [k for k, e in self.entries.items() if e[1].intersection(tables)]:
+            self.size -= self.entries.pop(key)[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": len(self.entries), "bytes": self.size}
+
+QUERY_CACHE = QueryCache()
+
+def cached_query(sql, params=(), tables=()):
+    """Run a read-only query through QUERY_CACHE; returns the list of rows."""
+    key = (sql, tuple(params))
+    rows = QUERY_CACHE.get(key)
+    if rows is None:
+        conn = sqlite3.connect(DB_PATH); c = conn.cursor()
+        c.execute(sql, params)
+        rows = c.fetchall()
+        conn.close()
+        QUERY_CACHE.put(key, rows, tables)
+    return rows
+
 # ---------------- Small KV for header ----------------
 KV = """
 <Header@BoxLayout>:
@@ -171,13 +243,9 @@ class Dashboard(Screen):
         # quick stats
         stats = BoxLayout(orientation="vertical", spacing=6)
         try:
-            conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-            c.execute("SELECT COUNT(*), COALESCE(SUM(price),0) FROM appointments")
-            tot_app, tot_inc = c.fetchone()
+            tot_app, tot_inc = cached_query("SELECT COUNT(*), COALESCE(SUM(price),0) FROM appointments", tables=("appointments",))[0]
             tot_app = tot_app or 0; tot_inc = tot_inc or 0.0
-            c.execute("SELECT COUNT(*) FROM products")
-            tot_prod = c.fetchone()[0] or 0
-            conn.close()
+            tot_prod = cached_query("SELECT COUNT(*) FROM products", tables=("products",))[0][0] or 0
             stats.add_widget(Label(text=f"Appuntamenti registrati: {tot_app}", color=COLOR_TEXT))
             stats.add_widget(Label(text=f"Incasso totale stimato: €{tot_inc:.2f}", color=COLOR_TEXT))
             stats.add_widget(Label(text=f"Prodotti in inventario: {tot_prod}", color=COLOR_TEXT))
@@ -200,11 +268,9 @@ class Dashboard(Screen):
 
         # upcoming appointments preview
         try:
-            conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-            now_iso = datetime.now().isoformat()
-            c.execute("SELECT client, datetime, service FROM appointments WHERE datetime >= ? ORDER BY datetime(datetime) ASC LIMIT 5", (now_iso,))
-            rows = c.fetchall()
-            conn.close()
+            # minute resolution (like stored datetimes) so the cache key is reusable
+            now_iso = datetime.now().replace(second=0, microsecond=0).isoformat()
+            rows = cached_query("SELECT client, datetime, service FROM appointments WHERE datetime >= ? ORDER BY datetime(datetime) ASC LIMIT 5", (now_iso,), ("appointments",))
             if rows:
                 preview = "\n".join([f"{r[1][:16]} — {r[0]} — {r[2]}" for r in rows])
             else:
@@ -237,14 +303,11 @@ class Inventory(Screen):
         grid.bind(minimum_height=grid.setter('height'))
 
         try:
-            conn = sqlite3.connect(DB_PATH); c = conn.cursor()
             q = self.search.text.strip().lower()
             if q:
-                c.execute("SELECT id, name, qty, unit_price, threshold FROM products WHERE lower(name) LIKE ? ORDER BY name", (f"%{q}%",))
+                rows = cached_query("SELECT id, name, qty, unit_price, threshold FROM products WHERE lower(name) LIKE ? ORDER BY name", (f"%{q}%",), ("products",))
             else:
-                c.execute("SELECT id, name, qty, unit_price, threshold FROM products ORDER BY name")
-            rows = c.fetchall()
-            conn.close()
+                rows = cached_query("SELECT id, name, qty, unit_price, threshold FROM products ORDER BY name", tables=("products",))
             if not rows:
                 grid.add_widget(Label(text="Nessun prodotto registrato", color=COLOR_TEXT))
             else:
@@ -294,6 +357,7 @@ class Inventory(Screen):
                 conn = sqlite3.connect(DB_PATH); c = conn.cursor()
                 c.execute("INSERT INTO products (name, qty, unit_price, threshold) VALUES (?,?,?,?)", (n, qv, pr, thv))
                 conn.commit(); conn.close()
+                QUERY_CACHE.invalidate("products")
                 popup.dismiss(); self.refresh()
             except sqlite3.IntegrityError:
                 show_msg("Errore", "Prodotto con questo nome già esistente")
@@ -326,6 +390,7 @@ class Inventory(Screen):
                     conn = sqlite3.connect(DB_PATH); c = conn.cursor()
                     c.execute("UPDATE products SET name=?, qty=?, unit_price=?, threshold=? WHERE id=?", (name.text.strip(), float(qty.text.strip() or "0"), float(price.text.strip() or "0"), float(thr.text.strip() or "0"), pid))
                     conn.commit(); conn.close()
+                    QUERY_CACHE.invalidate("products")
                     popup.dismiss(); self.refresh()
                 except sqlite3.IntegrityError:
                     show_msg("Errore", "Nome duplicato")
@@ -349,6 +414,7 @@ class Inventory(Screen):
             try:
                 conn = sqlite3.connect(DB_PATH); c = conn.cursor()
                 c.execute("DELETE FROM products WHERE id=?", (pid,)); conn.commit(); conn.close()
+                QUERY_CACHE.invalidate("products")
                 popup.dismiss(); self.refresh()
             except Exception as e:
                 show_msg("Errore", str(e))
@@ -376,15 +442,12 @@ class Appointments(Screen):
         grid.bind(minimum_height=grid.setter('height'))
 
         try:
-            conn = sqlite3.connect(DB_PATH); c = conn.cursor()
             q = self.search.text.strip().lower()
             if q:
-                c.execute("""SELECT id, client, address, datetime, service, price FROM appointments
-                             WHERE lower(client) LIKE ? OR lower(address) LIKE ? ORDER BY datetime(datetime) ASC""", (f"%{q}%", f"%{q}%"))
+                rows = cached_query("""SELECT id, client, address, datetime, service, price FROM appointments
+                             WHERE lower(client) LIKE ? OR lower(address) LIKE ? ORDER BY datetime(datetime) ASC""", (f"%{q}%", f"%{q}%"), ("appointments",))
             else:
-                c.execute("SELECT id, client, address, datetime, service, price FROM appointments ORDER BY datetime(datetime) ASC")
-            rows = c.fetchall()
-            conn.close()
+                rows = cached_query("SELECT id, client, address, datetime, service, price FROM appointments ORDER BY datetime(datetime) ASC", tables=("appointments",))
             if not rows:
                 grid.add_widget(Label(text="Nessun appuntamento registrato", color=COLOR_TEXT, size_hint_y=None, height=dp(40)))
             else:
@@ -458,6 +521,7 @@ class Appointments(Screen):
                     except Exception:
                         pass
                 conn.close()
+                QUERY_CACHE.invalidate("appointments", "products")
                 popup.dismiss(); self.refresh()
             except Exception as e:
                 show_msg("Errore", str(e))
@@ -494,6 +558,7 @@ class Appointments(Screen):
                     conn = sqlite3.connect(DB_PATH); c = conn.cursor()
                     c.execute("UPDATE appointments SET client=?, address=?, datetime=?, service=?, price=?, consumption=? WHERE id=?", (cl, ad, dt_txt, srv, pr, cons, aid))
                     conn.commit(); conn.close()
+                    QUERY_CACHE.invalidate("appointments")
                     popup.dismiss(); self.refresh()
                 except Exception as e:
                     show_msg("Errore", str(e))
@@ -514,6 +579,7 @@ class Appointments(Screen):
             try:
                 conn = sqlite3.connect(DB_PATH); c = conn.cursor()
                 c.execute("DELETE FROM appointments WHERE id=?", (aid,)); conn.commit(); conn.close()
+                QUERY_CACHE.invalidate("appointments")
                 popup.dismiss(); self.refresh()
             except Exception as e:
                 show_msg("Errore", str(e))
@@ -526,19 +592,17 @@ class Stats(Screen):
         root = BoxLayout(orientation='vertical', padding=8, spacing=8)
         root.add_widget(Label(text="📊 Statistiche", font_size="20sp", color=COLOR_VIOLET, size_hint_y=None, height=dp(36)))
         try:
-            conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-            c.execute("SELECT COUNT(*), COALESCE(SUM(price),0) FROM appointments")
-            tot_app, tot_inc = c.fetchone()
+            tot_app, tot_inc = cached_query("SELECT COUNT(*), COALESCE(SUM(price),0) FROM appointments", tables=("appointments",))[0]
             tot_app = tot_app or 0; tot_inc = tot_inc or 0.0
-            c.execute("SELECT COUNT(*) FROM products")
-            tot_prod = c.fetchone()[0] or 0
-            c.execute("SELECT service, COUNT(*) as cnt FROM appointments GROUP BY service ORDER BY cnt DESC LIMIT 1")
-            top = c.fetchone(); top_service = top[0] if top else "—"
-            conn.close()
+            tot_prod = cached_query("SELECT COUNT(*) FROM products", tables=("products",))[0][0] or 0
+            top = cached_query("SELECT service, COUNT(*) as cnt FROM appointments GROUP BY service ORDER BY cnt DESC LIMIT 1", tables=("appointments",))
+            top_service = top[0][0] if top else "—"
             root.add_widget(Label(text=f"Totale appuntamenti: {tot_app}", color=COLOR_TEXT))
             root.add_widget(Label(text=f"Incasso totale: €{tot_inc:.2f}", color=COLOR_TEXT))
             root.add_widget(Label(text=f"Prodotti in inventario: {tot_prod}", color=COLOR_TEXT))
             root.add_widget(Label(text=f"Servizio più richiesto: {top_service}", color=COLOR_TEXT))
+            cs = QUERY_CACHE.stats()
+            root.add_widget(Label(text=f"Cache query: {cs['hits']} hit / {cs['misses']} miss ({cs['entries']} voci, {cs['bytes'] // 1024} KB)", font_size='12sp', color=(0.4,0.4,0.4,1)))
         except Exception as e:
             root.add_widget(Label(text="Errore lettura statistiche", color=COLOR_TEXT))
         root.add_widget(Button(text="← Torna", size_hint_y=None, height=dp(44), background_color=COLOR_VIOLET, color=(1,1,1,1), on_release=lambda *a: self.manager.go("dashboard")))
@@ -588,6 +652,7 @@ class Backup(Screen):
             for a in data.get("appointments", []):
                 c.execute("INSERT INTO appointments (client, address, datetime, service, price, consumption) VALUES (?,?,?,?,?,?)", (a.get("client"), a.get("address"), a.get("datetime"), a.get("service"), a.get("price", 0.0), a.get("consumption", "")))
             conn.commit(); conn.close()
+            QUERY_CACHE.invalidate("products", "appointments")
             show_msg("Import", "Import completato (DB sovrascritto)")
         except Exception as e:
             show_msg("Errore import", str(e))